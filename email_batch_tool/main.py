@@ -1,11 +1,18 @@
 """主程序入口"""
 
 import argparse
+import codecs
 import json
+import mmap
+import os
 import sys
-from typing import List
+from typing import List, Union
+from email_batch_tool.utils import json_utils
 from email_batch_tool.utils.email_sender import OutlookEmailSender, BatchEmailProcessor
 
+# Bytes of the template checked for valid UTF-8 at a time
+_UTF8_CHECK_CHUNK_SIZE = 1 << 20
+
 
 def load_recipients(file_path: str) -> List[str]:
     """
@@ -19,16 +26,24 @@ def load_recipients(file_path: str) -> List[str]:
     """
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read().strip()
+            # Skip leading whitespace to see whether the file looks like a JSON array
+            first_char = f.read(1)
+            while first_char.isspace():
+                first_char = f.read(1)
             
-        # Try to parse as JSON array first
-        try:
-            recipients = json.loads(content)
-            if isinstance(recipients, list):
-                return [str(email).strip() for email in recipients if str(email).strip()]
-        except json.JSONDecodeError:
-            # If not JSON, treat as plain text with one email per line
-            return [line.strip() for line in content.split('\n') if line.strip()]
+            # Try to parse as JSON array first
+            if first_char == '[':
+                f.seek(0)
+                try:
+                    recipients = json_utils.loads(f.read())
+                    if isinstance(recipients, list):
+                        return [str(email).strip() for email in recipients if str(email).strip()]
+                except json.JSONDecodeError:
+                    pass
+            
+            # If not JSON, stream the file as plain text with one email per line
+            f.seek(0)
+            return [line for line in (raw.strip() for raw in f) if line]
             
     except FileNotFoundError:
         print(f"Error: Recipients file '{file_path}' not found.")
@@ -38,19 +53,37 @@ def load_recipients(file_path: str) -> List[str]:
         sys.exit(1)
 
 
-def load_html_template(file_path: str) -> str:
+def open_html_template(file_path: str) -> Union[mmap.mmap, bytes]:
     """
-    Load HTML email template from file.
+    Memory-map HTML email template file.
+    
+    The template is decoded straight from the map, so its contents are never
+    read into an intermediate bytes object. The caller closes the map.
     
     Args:
         file_path: Path to HTML template file
         
     Returns:
-        HTML content as string
+        Read-only memory map of the UTF-8 encoded HTML, or b"" for an empty file
+        (which cannot be mapped)
     """
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return f.read()
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            template = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        # Reject invalid UTF-8 now rather than after authenticating; checking in
+        # chunks avoids decoding the whole template a second time
+        try:
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            for start in range(0, len(template), _UTF8_CHECK_CHUNK_SIZE):
+                decoder.decode(template[start:start + _UTF8_CHECK_CHUNK_SIZE])
+            decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            template.close()
+            raise
+        return template
     except FileNotFoundError:
         print(f"Error: HTML template file '{file_path}' not found.")
         sys.exit(1)
@@ -111,6 +144,12 @@ Examples:
                        help="Email addresses to CC (can specify multiple)")
     parser.add_argument("--output", "-o",
                        help="Path to save results JSON file")
+    parser.add_argument("--batch-mode", action="store_true",
+                       help="Send up to 20 emails per request via the Graph $batch endpoint; "
+                            "delays then apply between batches instead of between emails")
+    parser.add_argument("--concurrency", type=int, default=1,
+                       help="Number of emails to send at the same time, each worker waiting the "
+                            "delay between its own emails (default: 1, strictly one at a time)")
     parser.add_argument("--dry-run", action="store_true",
                        help="Perform a dry run without sending emails")
     parser.add_argument("--version", action="version", version="1.0.0")
@@ -121,7 +160,7 @@ Examples:
     if args.config:
         try:
             with open(args.config, 'r', encoding='utf-8') as f:
-                config = json.load(f)
+                config = json_utils.loads(f.read())
         except Exception as e:
             print(f"Error loading config file: {str(e)}")
             sys.exit(1)
@@ -133,6 +172,13 @@ Examples:
             "shared_mailbox": args.shared_mailbox
         }
     
+    if args.concurrency < 1:
+        print("Error: --concurrency must be at least 1")
+        sys.exit(1)
+    if args.batch_mode and args.concurrency > 1:
+        print("Error: --concurrency cannot be combined with --batch-mode")
+        sys.exit(1)
+    
     # Validate required config fields
     required_fields = ["tenant_id", "client_id", "client_secret", "shared_mailbox"]
     for field in required_fields:
@@ -140,9 +186,8 @@ Examples:
             print(f"Error: Missing required configuration field '{field}'")
             sys.exit(1)
     
-    # Load recipients and template
+    # Load recipients
     recipients = load_recipients(args.recipients)
-    html_template = load_html_template(args.template)
     
     print(f"Loaded {len(recipients)} recipients")
     print(f"Using subject: {args.subject}")
@@ -154,36 +199,48 @@ Examples:
         print(f"  Min delay: {args.min_delay} seconds")
         print(f"  Max delay: {args.max_delay} seconds")
         print(f"  Max retries: {args.max_retries}")
+        print(f"  Batch mode: {args.batch_mode}")
+        print(f"  Concurrency: {args.concurrency}")
         return
     
-    # Initialize email sender
-    email_sender = OutlookEmailSender(
-        tenant_id=config["tenant_id"],
-        client_id=config["client_id"],
-        client_secret=config["client_secret"],
-        shared_mailbox=config["shared_mailbox"]
-    )
-    
-    # Authenticate
-    print("Authenticating with Microsoft Graph API...")
-    if not email_sender.authenticate():
-        print("Authentication failed. Exiting.")
-        sys.exit(1)
+    # The template is only needed when actually sending
+    html_template = open_html_template(args.template)
     
-    # Initialize batch processor
-    batch_processor = BatchEmailProcessor(email_sender)
-    
-    # Send emails
-    print("Starting batch email sending...")
-    results = batch_processor.send_batch(
-        recipients=recipients,
-        subject=args.subject,
-        html_template=html_template,
-        min_delay=args.min_delay,
-        max_delay=args.max_delay,
-        max_retries=args.max_retries,
-        cc_addresses=args.cc
-    )
+    try:
+        # Initialize email sender
+        email_sender = OutlookEmailSender(
+            tenant_id=config["tenant_id"],
+            client_id=config["client_id"],
+            client_secret=config["client_secret"],
+            shared_mailbox=config["shared_mailbox"],
+            max_connections=max(4, args.concurrency)
+        )
+        
+        # Authenticate
+        print("Authenticating with Microsoft Graph API...")
+        if not email_sender.authenticate():
+            print("Authentication failed. Exiting.")
+            sys.exit(1)
+        
+        # Initialize batch processor
+        batch_processor = BatchEmailProcessor(email_sender)
+        
+        # Send emails
+        print("Starting batch email sending...")
+        results = batch_processor.send_batch(
+            recipients=recipients,
+            subject=args.subject,
+            html_template=html_template,
+            min_delay=args.min_delay,
+            max_delay=args.max_delay,
+            max_retries=args.max_retries,
+            cc_addresses=args.cc,
+            batch_mode=args.batch_mode,
+            concurrency=args.concurrency
+        )
+    finally:
+        if isinstance(html_template, mmap.mmap):
+            html_template.close()
     
     # Output results
     print("\n" + "="*50)
@@ -6,27 +6,184 @@ This module implements a safe, compliant 1-to-1 email delivery system.
 import time
 import random
 import logging
-import json
+import logging.handlers
+import atexit
 import base64
 import re
 import os
+import mmap
+import hashlib
+import threading
+import functools
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Tuple
+from typing import Callable, List, Optional, Dict, Tuple, Union
 import msal
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
+from email_batch_tool.utils import json_utils
 
 # Configure logging
+# File writes are buffered and flushed every 256 records, on errors, at exit, and
+# after each recorded send result, so the log always shows who was already emailed
+# even if the process is killed
+_LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+_file_handler = logging.FileHandler("email_batch.log")
+# The file handler formats records itself when the buffer is flushed
+_file_handler.setFormatter(logging.Formatter(_LOG_FORMAT))
+_buffered_file_handler = logging.handlers.MemoryHandler(
+    capacity=256, flushLevel=logging.ERROR, target=_file_handler)
+atexit.register(_file_handler.close)
+atexit.register(_buffered_file_handler.flush)
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
+    format=_LOG_FORMAT,
     handlers=[
-        logging.FileHandler("email_batch.log"),
+        _buffered_file_handler,
         logging.StreamHandler()
     ]
 )
 logger = logging.getLogger(__name__)
 
+# Placeholder recipient spliced out of the serialized message body
+_RECIPIENT_PLACEHOLDER = json_utils.dumps("__RECIPIENT__")
+
+# OAuth scopes requested for Microsoft Graph with the client credentials flow
+_GRAPH_SCOPES = ["https://graph.microsoft.com/.default"]
+
+# Sends treat a token as expired this close to its expiry
+_TOKEN_EXPIRY_MARGIN = timedelta(minutes=2)
+# The background refresh runs this close to expiry. MSAL stops serving a cached token
+# once it has less than 5 minutes left, so by then the refresh fetches a new one, and
+# it finishes before any send sees the token as expired.
+_TOKEN_REFRESH_LEAD = timedelta(minutes=4)
+
+# Maximum number of subrequests Microsoft Graph accepts in one $batch call
+GRAPH_BATCH_LIMIT = 20
+# Maximum $batch request body size; every subrequest repeats the full message,
+# inline images included, so large templates need smaller groups
+GRAPH_BATCH_MAX_BYTES = 4 * 1024 * 1024
+
+# Quoted img src values, and every img tag opening; unless each img tag yields
+# exactly one src match, the template needs a real parser. Attributes before src
+# are stepped over whole, so a "src=" inside another attribute's value never matches.
+_IMG_SRC_RE = re.compile(r'''<img\b(?:\s+[^\s=>"']+(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s>"']+))?)*?'''
+                         r'''\s+src\s*=\s*(?:"([^"]*)"|'([^']*)')''', re.IGNORECASE)
+_IMG_OPEN_RE = re.compile(r'<img\b', re.IGNORECASE)
+
+# Templates containing script or style elements go through the sanitizing parser
+_SCRIPT_STYLE_RE = re.compile(r'<(?:script|style)\b', re.IGNORECASE)
+
+# Prefix of an image data URL; the MIME type runs up to the first ';'
+_DATA_URL_PREFIX = 'data:image/'
+
+# Relative image paths are resolved against the project's template directory
+# (assuming the HTML content is from template/email.html)
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_TEMPLATE_DIR = os.path.join(_PROJECT_ROOT, 'template')
+_IMAGES_DIR = os.path.join(_TEMPLATE_DIR, 'images')
+
+# MIME types by file extension; anything else is sent as image/png
+_EXT_MIME = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.png': 'image/png',
+}
+
+# Processed templates keyed by content digest, least recently used first
+_TEMPLATE_CACHE_SIZE = 16
+_template_cache = OrderedDict()
+
+# Read size for streaming base64; a multiple of 3 so chunks encode without padding
+_B64_CHUNK_SIZE = 3 * 16384
+
+
+def _b64_file(path: str) -> str:
+    """
+    Base64-encode a file chunk by chunk into a preallocated buffer.
+    
+    Args:
+        path: Path of the file to encode
+        
+    Returns:
+        str: Base64-encoded file contents
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        buf = bytearray(4 * ((size + 2) // 3))
+        pos = 0
+        for chunk in iter(lambda: f.read(_B64_CHUNK_SIZE), b''):
+            encoded = base64.b64encode(chunk)
+            buf[pos:pos + len(encoded)] = encoded
+            pos += len(encoded)
+    # Trim in case the file shrank after it was opened
+    del buf[pos:]
+    return buf.decode('ascii')
+
+
+def _load_local_image(src: str) -> Tuple[str, Optional[str]]:
+    """
+    Locate a relative image path and base64-encode its contents.
+    
+    Args:
+        src: Image path from the img tag, e.g. "logo.png" or "images/logo.png"
+        
+    Returns:
+        Tuple of (image_path, base64_data); base64_data is None if the file was not found
+    """
+    candidates = [os.path.join(_IMAGES_DIR, src)]
+    # Alternative path resolution for relative paths like "images/filename.png"
+    if '/' in src:
+        candidates.append(os.path.join(_TEMPLATE_DIR, src))
+    
+    for image_path in candidates:
+        try:
+            return image_path, _b64_file(image_path)
+        except FileNotFoundError:
+            continue
+    return image_path, None
+
+
+def _is_relative_image_path(src: str) -> bool:
+    """
+    Check whether an img src refers to an image file relative to the template directory.
+    
+    Args:
+        src: Value of the img tag's src attribute
+        
+    Returns:
+        bool: True for paths like "images/filename.png"
+    """
+    return not src.startswith(('data:', 'file://', '/', 'http', 'cid:'))
+
+
+def _load_local_images(srcs: List[str]) -> Dict[str, Union[Tuple[str, Optional[str]], Exception]]:
+    """
+    Read and base64-encode several local images concurrently.
+    
+    File reads and base64 encoding both release the GIL, so threads overlap the work.
+    
+    Args:
+        srcs: Relative image paths from img tags
+        
+    Returns:
+        Dict mapping each path to the result of _load_local_image, or to the exception it raised
+    """
+    def load(src):
+        try:
+            return _load_local_image(src)
+        except Exception as e:
+            return e
+    
+    unique_srcs = list(dict.fromkeys(srcs))
+    if not unique_srcs:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(8, len(unique_srcs))) as executor:
+        return dict(zip(unique_srcs, executor.map(load, unique_srcs)))
+
 
 class OutlookEmailSender:
     """
@@ -34,7 +191,7 @@ class OutlookEmailSender:
     """
 
     def __init__(self, tenant_id: str, client_id: str, client_secret: str, 
-                 shared_mailbox: str):
+                 shared_mailbox: str, max_connections: int = 4):
         """
         Initialize the Outlook email sender.
         
@@ -43,6 +200,7 @@ class OutlookEmailSender:
             client_id: Application (client) ID
             client_secret: Client secret
             shared_mailbox: Shared mailbox email address
+            max_connections: Maximum number of pooled connections to Microsoft Graph
         """
         self.tenant_id = tenant_id
         self.client_id = client_id
@@ -51,28 +209,100 @@ class OutlookEmailSender:
         self.access_token = None
         self.token_expires_at = None
         self.base_url = "https://graph.microsoft.com/v1.0"
+        self._send_url = f"{self.base_url}/users/{self.shared_mailbox}/sendMail"
+        self._batch_url = f"{self.base_url}/$batch"
+        self._headers = None
+        self._authority = f"https://login.microsoftonline.com/{self.tenant_id}"
+        # Created by the first authenticate() call, since construction fetches the
+        # authority's discovery metadata and may fail
+        self._msal_app = None
+        # Serializes authentication so concurrent callers wait for one refresh
+        self._auth_lock = threading.Lock()
+        
+        # Reuse one pooled session so keep-alive avoids a new TLS handshake per email
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=max_connections,
+                                                    max_retries=0))
         
     def authenticate(self) -> bool:
         """
         Authenticate with Microsoft Graph API using client credentials flow.
         
+        Returns:
+            bool: True if authentication successful, False otherwise
+        """
+        with self._auth_lock:
+            return self._authenticate()
+            
+    def ensure_token(self) -> bool:
+        """
+        Make sure a valid access token is available, authenticating only if needed.
+        
+        If another thread is already authenticating, this waits for it and uses
+        its token instead of starting a second authentication.
+        
+        Returns:
+            bool: True if a valid access token is available, False otherwise
+        """
+        if not self.is_token_expired():
+            return True
+        
+        with self._auth_lock:
+            # Another thread may have refreshed the token while we waited
+            if not self.is_token_expired():
+                return True
+            logger.info("Access token is missing or expired. Authenticating...")
+            return self._authenticate()
+            
+    def _reauthenticate(self, rejected_headers: Dict[str, str]) -> bool:
+        """
+        Get a new token after Graph rejected the one sent with rejected_headers.
+        
+        MSAL's token cache would hand back the rejected token while it looks
+        valid, so the app and its cache are rebuilt for this authentication.
+        
+        Args:
+            rejected_headers: Request headers that carried the rejected token
+            
+        Returns:
+            bool: True if a new access token is available, False otherwise
+        """
+        with self._auth_lock:
+            # Another thread may already have replaced the rejected token
+            if self._headers is not rejected_headers:
+                return True
+            self._msal_app = None
+            return self._authenticate()
+            
+    def _authenticate(self) -> bool:
+        """
+        Acquire a token; the caller must hold _auth_lock.
+        
         Returns:
             bool: True if authentication successful, False otherwise
         """
         try:
-            app = msal.ConfidentialClientApplication(
-                client_id=self.client_id,
-                client_credential=self.client_secret,
-                authority=f"https://login.microsoftonline.com/{self.tenant_id}"
-            )
+            # Keep one app so re-authentication skips authority discovery and its
+            # token cache serves still-valid tokens without a network call
+            if self._msal_app is None:
+                self._msal_app = msal.ConfidentialClientApplication(
+                    client_id=self.client_id,
+                    client_credential=self.client_secret,
+                    authority=self._authority,
+                    token_cache=msal.SerializableTokenCache()
+                )
             
-            result = app.acquire_token_for_client(scopes=["https://graph.microsoft.com/.default"])
+            result = self._msal_app.acquire_token_for_client(scopes=_GRAPH_SCOPES)
             
             if "access_token" in result:
                 self.access_token = result["access_token"]
-                # Set token expiration time (typically 1 hour for Azure AD tokens)
-                # We'll set it to 55 minutes to be safe
-                self.token_expires_at = datetime.now() + timedelta(minutes=55)
+                self._headers = {
+                    "Authorization": f"Bearer {self.access_token}",
+                    "Content-Type": "application/json"
+                }
+                # Use the remaining lifetime reported by MSAL (typically 1 hour for Azure AD
+                # tokens), since a cached token may already be partway through it
+                self.token_expires_at = datetime.now() + timedelta(seconds=result.get("expires_in", 3600))
                 logger.info("Authentication successful")
                 logger.info(f"Token expires at: {self.token_expires_at.isoformat()}")
                 return True
@@ -89,62 +319,42 @@ class OutlookEmailSender:
         Check if the current access token is expired or about to expire.
         
         Returns:
-            bool: True if token is expired or will expire in the next 5 minutes, False otherwise
+            bool: True if token is expired or will expire in the next 2 minutes, False otherwise
         """
         if not self.access_token or not self.token_expires_at:
             return True
             
-        # Consider token expired if it will expire in the next 5 minutes
-        return datetime.now() >= (self.token_expires_at - timedelta(minutes=5))
+        # Consider token expired if it will expire in the next 2 minutes
+        return datetime.now() >= (self.token_expires_at - _TOKEN_EXPIRY_MARGIN)
             
-    def send_email(self, to_address: str, subject: str, html_body: str, attachments: Optional[List[Dict]] = None, cc_addresses: Optional[List[str]] = None) -> bool:
+    def build_message(self, subject: str, html_body: str, attachments: Optional[List[Dict]] = None,
+                      cc_addresses: Optional[List[str]] = None) -> Dict:
         """
-        Send a single email to a recipient with optional inline images and CC recipients.
+        Build the recipient-independent part of a sendMail payload.
+        
+        Subject, body, CC recipients and attachments are identical for every
+        recipient in a batch, so this is built once and reused by send_email.
         
         Args:
-            to_address: Recipient email address
             subject: Email subject
             html_body: HTML email body
             attachments: List of attachment dictionaries with 'contentBytes', 'name', and 'contentType'
             cc_addresses: List of CC recipient email addresses
             
         Returns:
-            bool: True if email sent successfully, False otherwise
+            Dict: sendMail payload without 'toRecipients'
         """
-        # Check if we need to authenticate or refresh token
-        if not self.access_token or self.is_token_expired():
-            logger.info("Access token is missing or expired. Authenticating...")
-            if not self.authenticate():
-                logger.error("Failed to authenticate and obtain access token.")
-                return False
-        
-        headers = {
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json"
-        }
-        
-        # Prepare email data
-        email_data = {
-            "message": {
-                "subject": subject,
-                "body": {
-                    "contentType": "HTML",
-                    "content": html_body
-                },
-                "toRecipients": [
-                    {
-                        "emailAddress": {
-                            "address": to_address
-                        }
-                    }
-                ]
-            },
-            "saveToSentItems": True
+        message = {
+            "subject": subject,
+            "body": {
+                "contentType": "HTML",
+                "content": html_body
+            }
         }
         
         # Add CC recipients if provided
         if cc_addresses:
-            cc_recipients = [
+            message["ccRecipients"] = [
                 {
                     "emailAddress": {
                         "address": cc_address
@@ -152,33 +362,98 @@ class OutlookEmailSender:
                 }
                 for cc_address in cc_addresses
             ]
-            email_data["message"]["ccRecipients"] = cc_recipients
         
         # Add attachments if provided
         if attachments:
-            email_data["message"]["attachments"] = attachments
+            message["attachments"] = attachments
+        
+        return {
+            "message": message,
+            "saveToSentItems": True
+        }
+            
+    def serialize_message(self, message_template: Dict) -> Tuple[bytes, bytes]:
+        """
+        Serialize a payload from build_message once, leaving a gap for the recipient.
+        
+        Args:
+            message_template: Payload returned by build_message
+            
+        Returns:
+            Tuple of (prefix, suffix) bytes; prefix + JSON-encoded address + suffix is the request body
+        """
+        email_data = {
+            "message": dict(message_template["message"], toRecipients=[
+                {
+                    "emailAddress": {
+                        "address": "__RECIPIENT__"
+                    }
+                }
+            ]),
+            "saveToSentItems": message_template["saveToSentItems"]
+        }
+        
+        # toRecipients is the last string in the body, so split on the last placeholder
+        prefix, _, suffix = json_utils.dumps(email_data).rpartition(_RECIPIENT_PLACEHOLDER)
+        return prefix, suffix
+            
+    def render_message(self, to_address: str, message_parts: Tuple[bytes, bytes]) -> bytes:
+        """
+        Splice a recipient into a pre-serialized sendMail body.
+        
+        Args:
+            to_address: Recipient email address
+            message_parts: (prefix, suffix) returned by serialize_message
+            
+        Returns:
+            bytes: Complete JSON request body
+        """
+        # Only the recipient changes between emails
+        prefix, suffix = message_parts
+        return prefix + json_utils.dumps(to_address) + suffix
+            
+    def send_email(self, to_address: str, subject: str, html_body: str, attachments: Optional[List[Dict]] = None,
+                   cc_addresses: Optional[List[str]] = None, message_parts: Optional[Tuple[bytes, bytes]] = None,
+                   cc_log_suffix: Optional[str] = None) -> bool:
+        """
+        Send a single email to a recipient with optional inline images and CC recipients.
+        
+        Args:
+            to_address: Recipient email address
+            subject: Email subject
+            html_body: HTML email body
+            attachments: List of attachment dictionaries with 'contentBytes', 'name', and 'contentType'
+            cc_addresses: List of CC recipient email addresses
+            message_parts: Pre-serialized body from serialize_message; when given, subject,
+                html_body, attachments and cc_addresses are not used to build the message
+            cc_log_suffix: Precomputed " with CC to ..." text for the success log message;
+                built from cc_addresses when not given
+            
+        Returns:
+            bool: True if email sent successfully, False otherwise
+        """
+        # Check if we need to authenticate or refresh token
+        if not self.ensure_token():
+            logger.error("Failed to authenticate and obtain access token.")
+            return False
+        
+        if message_parts is None:
+            message_parts = self.serialize_message(
+                self.build_message(subject, html_body, attachments, cc_addresses))
+        
+        body = self.render_message(to_address, message_parts)
         
         # Send the email
         try:
-            url = f"{self.base_url}/users/{self.shared_mailbox}/sendMail"
-            response = requests.post(url, headers=headers, json=email_data)
-            
-            # Check if token is expired (401 error with specific message)
-            if response.status_code == 401:
-                error_response = response.json()
-                if "error" in error_response and error_response["error"]["code"] == "InvalidAuthenticationToken":
-                    logger.warning("Access token expired during request. Re-authenticating...")
-                    # Re-authenticate to get a new token
-                    if self.authenticate():
-                        # Retry the request with new token
-                        headers["Authorization"] = f"Bearer {self.access_token}"
-                        response = requests.post(url, headers=headers, json=email_data)
-                    else:
-                        logger.error("Failed to refresh access token.")
-                        return False
+            response = self._post_with_reauth(self._send_url, body, timeout=(5, 30))
+            if response is None:
+                return False
             
             if response.status_code == 202:
-                logger.info(f"Email sent successfully to {to_address}" + (f" with CC to {', '.join(cc_addresses)}" if cc_addresses else ""))
+                # Lazy formatting: nothing is stringified unless INFO is enabled
+                if cc_log_suffix is None:
+                    cc_log_suffix = f" with CC to {', '.join(cc_addresses)}" if cc_addresses else ""
+                logger.info("Email sent successfully to %s%s", to_address, cc_log_suffix)
                 return True
             else:
                 logger.error(f"Failed to send email to {to_address}. Status: {response.status_code}, Response: {response.text}")
@@ -188,6 +463,115 @@ class OutlookEmailSender:
             logger.error(f"Error sending email to {to_address}: {str(e)}")
             return False
             
+    def _post_with_reauth(self, url: str, body: bytes,
+                          timeout: Tuple[int, int]) -> Optional[requests.Response]:
+        """
+        POST a request body to Graph, re-authenticating and retrying once if the token is rejected.
+        
+        Args:
+            url: Request URL
+            body: Serialized JSON request body
+            timeout: (connect, read) timeout in seconds
+            
+        Returns:
+            The response, or None if the token was rejected and re-authentication failed
+        """
+        headers = self._headers
+        response = self._session.post(url, headers=headers, data=body, timeout=timeout)
+        
+        # Check if token is expired (401 error with specific message)
+        if response.status_code == 401:
+            error_response = response.json()
+            if "error" in error_response and error_response["error"]["code"] == "InvalidAuthenticationToken":
+                logger.warning("Access token expired during request. Re-authenticating...")
+                # Re-authenticate to get a new token
+                if self._reauthenticate(headers):
+                    # Retry the request with new token
+                    response = self._session.post(url, headers=self._headers, data=body, timeout=timeout)
+                else:
+                    logger.error("Failed to refresh access token.")
+                    return None
+        
+        return response
+            
+    def send_batch_via_graph(self, messages: List[bytes]) -> List[bool]:
+        """
+        Send several emails through the Microsoft Graph $batch endpoint.
+        
+        Messages are grouped into $batch calls of up to GRAPH_BATCH_LIMIT
+        sendMail subrequests, so N emails take roughly N/20 HTTP round trips.
+        Groups are made smaller when needed to keep each call's body within
+        GRAPH_BATCH_MAX_BYTES.
+        
+        Args:
+            messages: Serialized sendMail request bodies, e.g. from render_message
+            
+        Returns:
+            List[bool]: Per-message success flags, in the same order as messages
+        """
+        statuses = [False] * len(messages)
+        
+        # Splice the already-serialized message bodies into batch subrequests
+        groups = []
+        group = []
+        size = len(b'{"requests":[]}')
+        for i, message in enumerate(messages):
+            header = json_utils.dumps({
+                "id": str(i),
+                "method": "POST",
+                "url": f"/users/{self.shared_mailbox}/sendMail",
+                "headers": {
+                    "Content-Type": "application/json"
+                }
+            })
+            subrequest = header[:-1] + b',"body":' + message + b'}'
+            # A message too large to share a call is still sent on its own
+            if group and (len(group) == GRAPH_BATCH_LIMIT or size + len(subrequest) + 1 > GRAPH_BATCH_MAX_BYTES):
+                groups.append(group)
+                group = []
+                size = len(b'{"requests":[]}')
+            group.append(subrequest)
+            size += len(subrequest) + 1
+        if group:
+            groups.append(group)
+        
+        for group in groups:
+            # Check if we need to authenticate or refresh token
+            if not self.ensure_token():
+                logger.error("Failed to authenticate and obtain access token.")
+                return statuses
+            
+            body = b'{"requests":[' + b','.join(group) + b']}'
+            
+            try:
+                response = self._post_with_reauth(self._batch_url, body, timeout=(5, 60))
+                if response is None:
+                    return statuses
+                
+                if response.status_code != 200:
+                    logger.error(f"Batch request failed. Status: {response.status_code}, Response: {response.text}")
+                    continue
+                
+                # Responses are not guaranteed to come back in request order
+                for sub_response in json_utils.loads(response.content)["responses"]:
+                    i = int(sub_response["id"])
+                    if sub_response["status"] == 202:
+                        statuses[i] = True
+                    else:
+                        logger.error(f"Batch subrequest {i} failed. Status: {sub_response['status']}, "
+                                     f"Response: {sub_response.get('body')}")
+                        
+            except Exception as e:
+                logger.error(f"Error sending batch request: {str(e)}")
+        
+        return statuses
+            
+    def close(self):
+        """
+        Close the underlying HTTP session and release pooled connections.
+        """
+        self._session.close()
+            
     def extract_inline_images(self, html_content: str) -> Tuple[str, List[Dict]]:
         """
         Extract inline images from HTML content and convert them to attachments.
@@ -199,18 +583,145 @@ class OutlookEmailSender:
             Tuple of (cleaned_html, attachments_list)
         """
         soup = BeautifulSoup(html_content, 'html.parser')
-        attachments = []
+        attachments = self._inline_images(soup)
+        return str(soup), attachments
+            
+    def _inline_images(self, soup: BeautifulSoup) -> List[Dict]:
+        """
+        Rewrite img tags in a parsed document to CID references, in place.
         
+        Args:
+            soup: Parsed HTML document
+            
+        Returns:
+            List of inline attachment dictionaries
+        """
         # Find all img tags with src attributes
-        for img_tag in soup.find_all('img', src=True):
-            src = img_tag['src']
-            
-            # Handle data URLs (base64 encoded images)
-            if src.startswith('data:'):
-                # Extract MIME type and base64 data
-                match = re.match(r'data:(image/[^;]+);base64,(.*)', src)
-                if match:
-                    mime_type, base64_data = match.groups()
+        img_tags = soup.find_all('img', src=True)
+        cid_srcs, attachments = self._inline_image_srcs([img_tag['src'] for img_tag in img_tags])
+        
+        for img_tag, cid_src in zip(img_tags, cid_srcs):
+            if cid_src is not None:
+                img_tag['src'] = cid_src
+        
+        return attachments
+            
+    def _inline_images_fast(self, html_content: str) -> Optional[Tuple[str, List[Dict]]]:
+        """
+        Rewrite img src attributes to CID references with a regex scan instead of a parser.
+        
+        Args:
+            html_content: HTML content with img tags
+            
+        Returns:
+            Tuple of (processed_html, attachments_list), or None if the img tags are
+            not simple enough to rewrite safely without parsing
+        """
+        # Comments may hide img tags that the parser would skip
+        if '<!--' in html_content:
+            return None
+        
+        # (start, end, value) of each quoted src value
+        srcs = []
+        for match in _IMG_SRC_RE.finditer(html_content):
+            group = 1 if match.group(1) is not None else 2
+            srcs.append((match.start(group), match.end(group), match.group(group)))
+        
+        # img tags without a quoted src (missing, unquoted, or after a malformed attribute)
+        # and entity-encoded URLs need a real parser
+        if len(srcs) != len(_IMG_OPEN_RE.findall(html_content)):
+            return None
+        if any('&' in src for _, _, src in srcs):
+            return None
+        
+        cid_srcs, attachments = self._inline_image_srcs([src for _, _, src in srcs])
+        
+        pieces = []
+        pos = 0
+        for (start, end, _), cid_src in zip(srcs, cid_srcs):
+            if cid_src is not None:
+                pieces.append(html_content[pos:start])
+                pieces.append(cid_src)
+                pos = end
+        pieces.append(html_content[pos:])
+        
+        return ''.join(pieces), attachments
+            
+    def _inline_image_srcs(self, srcs: List[str]) -> Tuple[List[Optional[str]], List[Dict]]:
+        """
+        Turn img src values into inline attachments.
+        
+        Local image files are loaded concurrently up front; attachments and CIDs
+        are then assigned in document order.
+        
+        Args:
+            srcs: Values of the img tags' src attributes, in document order
+            
+        Returns:
+            Tuple of (replacement "cid:" src or None for each src, attachments_list)
+        """
+        local_images = _load_local_images([src for src in srcs if _is_relative_image_path(src)])
+        
+        attachments = []
+        cid_srcs = [self._inline_image(src, attachments, local_images) for src in srcs]
+        return cid_srcs, attachments
+            
+    def _inline_image(self, src: str, attachments: List[Dict],
+                      local_images: Dict[str, Union[Tuple[str, Optional[str]], Exception]]) -> Optional[str]:
+        """
+        Turn one img src into an inline attachment.
+        
+        Args:
+            src: Value of the img tag's src attribute
+            attachments: Attachment list; the new attachment is appended to it
+            local_images: Preloaded local images from _load_local_images
+            
+        Returns:
+            The replacement "cid:" src, or None if the image is left as it is
+        """
+        # Handle data URLs (base64 encoded images)
+        if src.startswith('data:'):
+            # Extract MIME type and base64 data
+            semi = src.find(';', len(_DATA_URL_PREFIX)) if src.startswith(_DATA_URL_PREFIX) else -1
+            if semi > len(_DATA_URL_PREFIX) and src.startswith(';base64,', semi):
+                mime_type = src[len('data:'):semi]
+                base64_data = src[semi + len(';base64,'):]
+                
+                # Generate a unique CID
+                cid = f"image_{len(attachments)+1}@example.com"
+                
+                # Create attachment
+                attachment = {
+                    "@odata.type": "#microsoft.graph.fileAttachment",
+                    "name": f"image_{len(attachments)+1}",
+                    "contentType": mime_type,
+                    "contentBytes": base64_data,
+                    "isInline": True,
+                    "contentId": cid
+                }
+                
+                attachments.append(attachment)
+                
+                # Replace src with CID reference
+                return f"cid:{cid}"
+        
+        # Handle local file paths (for development/testing)
+        elif src.startswith('file://') or src.startswith('/'):
+            # In production, you would need to implement actual file loading
+            # For now, we'll just log and skip
+            logger.warning(f"Local file path detected but not supported: {src}")
+        
+        # Handle relative image paths (e.g., images/filename.png)
+        elif _is_relative_image_path(src):
+            try:
+                loaded = local_images[src]
+                if isinstance(loaded, Exception):
+                    raise loaded
+                image_path, base64_data = loaded
+                
+                if base64_data is not None:
+                    # Determine MIME type from file extension
+                    mime_type = _EXT_MIME.get(os.path.splitext(src)[1].lower(), 'image/png')
                     
                     # Generate a unique CID
                     cid = f"image_{len(attachments)+1}@example.com"
@@ -218,7 +729,7 @@ class OutlookEmailSender:
                     # Create attachment
                     attachment = {
                         "@odata.type": "#microsoft.graph.fileAttachment",
-                        "name": f"image_{len(attachments)+1}",
+                        "name": src.split('/')[-1],  # Just the filename
                         "contentType": mime_type,
                         "contentBytes": base64_data,
                         "isInline": True,
@@ -227,72 +738,19 @@ class OutlookEmailSender:
                     
                     attachments.append(attachment)
                     
+                    logger.info(f"Processed local image: {src} -> CID: {cid}")
                     # Replace src with CID reference
-                    img_tag['src'] = f"cid:{cid}"
-            
-            # Handle local file paths (for development/testing)
-            elif src.startswith('file://') or src.startswith('/'):
-                # In production, you would need to implement actual file loading
-                # For now, we'll just log and skip
-                logger.warning(f"Local file path detected but not supported: {src}")
-            
-            # Handle relative image paths (e.g., images/filename.png)
-            elif not src.startswith('http') and not src.startswith('cid:'):
-                try:
-                    # Get the directory of the template file
-                    # Assuming the HTML content is from template/email.html
-                    project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-                    images_dir = os.path.join(project_root, 'template', 'images')
-                    image_path = os.path.join(images_dir, src)
-                    
-                    # Alternative path resolution for relative paths like "images/filename.png"
-                    if not os.path.exists(image_path) and '/' in src:
-                        # Try to resolve relative to template directory
-                        template_dir = os.path.join(project_root, 'template')
-                        image_path = os.path.join(template_dir, src)
-                    
-                    # Check if file exists
-                    if os.path.exists(image_path):
-                        # Determine MIME type from file extension
-                        _, ext = os.path.splitext(src)
-                        mime_type = 'image/png'  # default
-                        if ext.lower() in ['.jpg', '.jpeg']:
-                            mime_type = 'image/jpeg'
-                        elif ext.lower() == '.gif':
-                            mime_type = 'image/gif'
-                        
-                        # Read and encode the image
-                        with open(image_path, 'rb') as image_file:
-                            base64_data = base64.b64encode(image_file.read()).decode('utf-8')
-                        
-                        # Generate a unique CID
-                        cid = f"image_{len(attachments)+1}@example.com"
-                        
-                        # Create attachment
-                        attachment = {
-                            "@odata.type": "#microsoft.graph.fileAttachment",
-                            "name": src.split('/')[-1],  # Just the filename
-                            "contentType": mime_type,
-                            "contentBytes": base64_data,
-                            "isInline": True,
-                            "contentId": cid
-                        }
-                        
-                        attachments.append(attachment)
-                        
-                        # Replace src with CID reference
-                        img_tag['src'] = f"cid:{cid}"
-                        logger.info(f"Processed local image: {src} -> CID: {cid}")
-                    else:
-                        logger.warning(f"Image file not found: {image_path}")
-                        logger.warning(f"Images directory: {images_dir}")
-                        logger.warning(f"Current working directory: {os.getcwd()}")
-                except Exception as e:
-                    logger.error(f"Error processing image {src}: {str(e)}")
-                    import traceback
-                    logger.error(traceback.format_exc())
+                    return f"cid:{cid}"
+                else:
+                    logger.warning(f"Image file not found: {image_path}")
+                    logger.warning(f"Images directory: {_IMAGES_DIR}")
+                    logger.warning(f"Current working directory: {os.getcwd()}")
+            except Exception as e:
+                logger.error(f"Error processing image {src}: {str(e)}")
+                import traceback
+                logger.error(traceback.format_exc())
         
-        return str(soup), attachments
+        return None
             
     def sanitize_html(self, html_content: str) -> str:
         """
@@ -305,7 +763,7 @@ class OutlookEmailSender:
             str: Sanitized HTML content
         """
         try:
-            soup = BeautifulSoup(html_content, 'html5lib')
+            soup = BeautifulSoup(html_content, 'lxml')
             
             # Remove script and style elements
             for script in soup(["script", "style"]):
@@ -316,6 +774,76 @@ class OutlookEmailSender:
         except Exception as e:
             logger.warning(f"HTML sanitization failed: {str(e)}")
             return html_content
+            
+    def prepare_template(self, html_content: Union[str, bytes, mmap.mmap]) -> Tuple[str, List[Dict]]:
+        """
+        Sanitize HTML and extract inline images in a single parse.
+        
+        Equivalent to sanitize_html followed by extract_inline_images, but the
+        template is only parsed once. Templates without script or style elements
+        are not parsed at all; their img tags are rewritten by a regex scan.
+        
+        Args:
+            html_content: Raw HTML content, or UTF-8 encoded HTML bytes (e.g. a memory-mapped file)
+            
+        Returns:
+            Tuple of (processed_html, attachments_list)
+        """
+        if not isinstance(html_content, str):
+            # Decode straight from the buffer so a memory-mapped template is never
+            # copied into an intermediate bytes object; this str is the only heap copy
+            html_content = str(html_content, 'utf-8')
+        
+        # Most templates have nothing to sanitize, so skip building a DOM when there
+        # are no script or style elements and the img tags can be rewritten directly
+        if not _SCRIPT_STYLE_RE.search(html_content):
+            processed = self._inline_images_fast(html_content)
+            if processed is not None:
+                return processed
+        
+        try:
+            soup = BeautifulSoup(html_content, 'lxml')
+            
+            # Remove script and style elements
+            for script in soup(["script", "style"]):
+                script.decompose()
+        except Exception as e:
+            logger.warning(f"HTML sanitization failed: {str(e)}")
+            soup = BeautifulSoup(html_content, 'html.parser')
+        
+        attachments = self._inline_images(soup)
+        return str(soup), attachments
+            
+    def prepare_template_cached(self, html_content: Union[str, bytes, mmap.mmap]) -> Tuple[str, List[Dict]]:
+        """
+        Same as prepare_template, but reuses the result for a template that was already processed.
+        
+        Templates are identified by a BLAKE2b digest of their content, so re-sending
+        the same template skips parsing and image encoding entirely.
+        
+        Args:
+            html_content: Raw HTML content, or UTF-8 encoded HTML bytes (e.g. a memory-mapped file)
+            
+        Returns:
+            Tuple of (processed_html, attachments_list)
+        """
+        data = html_content.encode('utf-8') if isinstance(html_content, str) else html_content
+        key = hashlib.blake2b(data, digest_size=16).digest()
+        
+        cached = _template_cache.get(key)
+        if cached is None:
+            processed_html, attachments = self.prepare_template(html_content)
+            cached = (processed_html, tuple(attachments))
+            _template_cache[key] = cached
+            if len(_template_cache) > _TEMPLATE_CACHE_SIZE:
+                _template_cache.popitem(last=False)
+        else:
+            _template_cache.move_to_end(key)
+            logger.info("Using cached processed template")
+        
+        # Hand out copies so callers can't modify the cached attachments
+        processed_html, attachments = cached
+        return processed_html, [dict(attachment) for attachment in attachments]
 
 
 class BatchEmailProcessor:
@@ -331,30 +859,93 @@ class BatchEmailProcessor:
             email_sender: Configured OutlookEmailSender instance
         """
         self.email_sender = email_sender
+        self._refresh_timer = None
+        self._refresh_stopped = True
+        # Guards _refresh_timer and _refresh_stopped against the timer thread
+        self._refresh_lock = threading.Lock()
         
-    def send_batch(self, recipients: List[str], subject: str, html_template: str,
+    def _start_token_refresh(self):
+        """
+        Start refreshing the access token in the background shortly before it expires.
+        
+        Refreshing ahead of time means no send has to wait for an authentication
+        round trip. The timer reschedules itself after each refresh until
+        _cancel_token_refresh is called.
+        """
+        with self._refresh_lock:
+            self._refresh_stopped = False
+        self._schedule_token_refresh()
+        
+    def _schedule_token_refresh(self):
+        """
+        Schedule the next background refresh, unless refreshing has been cancelled.
+        """
+        if self.email_sender.token_expires_at is None:
+            delay = 0
+        else:
+            refresh_at = self.email_sender.token_expires_at - _TOKEN_REFRESH_LEAD
+            # Never spin if the token is already inside the refresh window
+            delay = max((refresh_at - datetime.now()).total_seconds(), 30)
+        
+        with self._refresh_lock:
+            if self._refresh_stopped:
+                return
+            self._refresh_timer = threading.Timer(delay, self._refresh_token)
+            self._refresh_timer.daemon = True
+            self._refresh_timer.start()
+        
+    def _refresh_token(self):
+        """
+        Re-authenticate in the background and schedule the next refresh.
+        """
+        logger.info("Refreshing access token in the background...")
+        if self.email_sender.authenticate():
+            # Does nothing if the batch finished while we were authenticating
+            self._schedule_token_refresh()
+        else:
+            # send_email will re-authenticate on demand
+            logger.warning("Background token refresh failed.")
+        
+    def _cancel_token_refresh(self):
+        """
+        Stop the background token refresh.
+        """
+        with self._refresh_lock:
+            self._refresh_stopped = True
+            if self._refresh_timer is not None:
+                self._refresh_timer.cancel()
+                self._refresh_timer = None
+        
+    def send_batch(self, recipients: List[str], subject: str, html_template: Union[str, bytes, mmap.mmap],
                    min_delay: int = 30, max_delay: int = 120, 
-                   max_retries: int = 3, cc_addresses: Optional[List[str]] = None) -> dict:
+                   max_retries: int = 3, cc_addresses: Optional[List[str]] = None,
+                   batch_mode: bool = False, concurrency: int = 1) -> dict:
         """
         Send emails to all recipients one by one with delays.
         
+        In batch mode, emails are sent through the Graph $batch endpoint in groups
+        of GRAPH_BATCH_LIMIT, and the delay applies between groups instead of
+        between individual emails.
+        
+        With concurrency above 1, that many emails are sent at the same time, each
+        worker waiting the random delay between its own emails.
+        
         Args:
             recipients: List of recipient email addresses
             subject: Email subject
-            html_template: HTML email template
+            html_template: HTML email template, as a string or UTF-8 encoded bytes
             min_delay: Minimum delay between emails in seconds
             max_delay: Maximum delay between emails in seconds
             max_retries: Maximum number of retries for failed emails
             cc_addresses: List of CC recipient email addresses (optional)
+            batch_mode: Send via the Graph $batch endpoint instead of one request per email
+            concurrency: Number of emails to send at the same time; 1 sends strictly one at a time
             
         Returns:
             dict: Summary of sending results
         """
-        # Sanitize HTML template
-        clean_html = self.email_sender.sanitize_html(html_template)
-        
-        # Extract inline images and prepare attachments
-        processed_html, attachments = self.email_sender.extract_inline_images(clean_html)
+        # Sanitize HTML template and extract inline images as attachments
+        processed_html, attachments = self.email_sender.prepare_template_cached(html_template)
         
         results = {
             "total": len(recipients),
@@ -364,54 +955,214 @@ class BatchEmailProcessor:
             "details": []
         }
         
+        # Everything except the recipient is the same for every email, so serialize it once
+        message_parts = self.email_sender.serialize_message(
+            self.email_sender.build_message(subject, processed_html, attachments, cc_addresses))
+        
         logger.info(f"Starting batch email send to {len(recipients)} recipients")
         logger.info(f"Delay range: {min_delay}-{max_delay} seconds")
         if cc_addresses:
             logger.info(f"CC recipients: {', '.join(cc_addresses)}")
         
-        for i, recipient in enumerate(recipients):
+        self._start_token_refresh()
+        
+        # Everything send_email needs besides the recipient, including its CC log text
+        cc_log_suffix = f" with CC to {', '.join(cc_addresses)}" if cc_addresses else ""
+        send = functools.partial(self.email_sender.send_email, subject=subject, html_body=processed_html,
+                                 attachments=attachments, cc_addresses=cc_addresses,
+                                 message_parts=message_parts, cc_log_suffix=cc_log_suffix)
+        
+        try:
+            if batch_mode:
+                self._send_graph_batches(recipients, message_parts, min_delay, max_delay, max_retries, results)
+            elif concurrency > 1:
+                self._send_concurrently(recipients, send, min_delay, max_delay, max_retries, concurrency, results)
+            else:
+                for i, recipient in enumerate(recipients):
+                    logger.info(f"Processing recipient {i+1}/{len(recipients)}: {recipient}")
+                    
+                    # Try to send email with retries
+                    success = self._send_with_retries(recipient, send, max_retries)
+                    
+                    # Record result
+                    self._record_result(results, recipient, success, max_retries)
+                    _buffered_file_handler.flush()
+                    
+                    # Add delay before next email (except for the last one)
+                    if i < len(recipients) - 1:
+                        delay = min_delay + random.random() * (max_delay - min_delay)
+                        logger.info(f"Waiting {delay:.1f} seconds before next email...")
+                        time.sleep(delay)
+        finally:
+            # Also stop the background refresh when the batch is interrupted
+            self._cancel_token_refresh()
+            self.email_sender.close()
+            _buffered_file_handler.flush()
+                
+        logger.info(f"Batch sending completed. Sent: {results['sent']}, Failed: {results['failed']}")
+        return results
+        
+    def _send_with_retries(self, recipient: str, send: Callable[[str], bool], max_retries: int,
+                           stopped: Optional[threading.Event] = None) -> bool:
+        """
+        Send one email, retrying failures with exponential backoff.
+        
+        Args:
+            recipient: Recipient email address
+            send: send_email with everything but the recipient bound
+            max_retries: Maximum number of retries for failed emails
+            stopped: Event that, once set, ends the backoff early and cancels further retries
+            
+        Returns:
+            bool: True if the email was eventually sent, False otherwise
+        """
+        for attempt in range(max_retries + 1):
+            if attempt > 0:
+                logger.info(f"Retry attempt {attempt}/{max_retries} for {recipient}")
+                
+            if send(recipient):
+                return True
+            elif attempt < max_retries:
+                # Check if this was a token expiration issue
+                # If so, we should re-authenticate and retry immediately
+                # Otherwise, use exponential backoff
+                delay = min(60 * (2 ** attempt), 300)  # Max 5 minutes
+                logger.warning(f"Send failed, waiting {delay} seconds before retry...")
+                if stopped is None:
+                    time.sleep(delay)
+                elif stopped.wait(delay):
+                    return False
+        
+        return False
+        
+    def _send_concurrently(self, recipients: List[str], send: Callable[[str], bool], min_delay: int,
+                           max_delay: int, max_retries: int, concurrency: int, results: dict):
+        """
+        Send emails on several worker threads over the sender's pooled session.
+        
+        Each worker behaves like the one-by-one loop: it waits a random delay
+        between its emails and retries failures with backoff, so up to
+        `concurrency` emails are in flight at once. Emails are handed to the
+        pool only as earlier ones finish, and an interrupt (e.g. Ctrl-C) also
+        cuts short workers waiting between emails or retries, so the batch
+        stops once the requests already on the wire complete.
+        
+        Args:
+            recipients: List of recipient email addresses
+            send: send_email with everything but the recipient bound
+            min_delay: Minimum delay between a worker's emails in seconds
+            max_delay: Maximum delay between a worker's emails in seconds
+            max_retries: Maximum number of retries for failed emails
+            concurrency: Number of emails sent at the same time
+            results: Summary dict updated in place
+        """
+        stopped = threading.Event()
+        
+        def send_one(i, recipient):
+            # The first email on each worker goes out immediately
+            if i >= concurrency:
+                delay = min_delay + random.random() * (max_delay - min_delay)
+                logger.info(f"Waiting {delay:.1f} seconds before next email...")
+                # Don't send after the batch has been interrupted
+                if stopped.wait(delay):
+                    return False
+            
             logger.info(f"Processing recipient {i+1}/{len(recipients)}: {recipient}")
+            return self._send_with_retries(recipient, send, max_retries, stopped)
+        
+        remaining = enumerate(recipients)
+        futures = {}
+        
+        def submit_next():
+            item = next(remaining, None)
+            if item is not None:
+                futures[executor.submit(send_one, *item)] = item[1]
+        
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            try:
+                for _ in range(concurrency):
+                    submit_next()
+                # Results are recorded on this thread, in the order emails finish
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._record_result(results, futures.pop(future), future.result(), max_retries)
+                        submit_next()
+                    _buffered_file_handler.flush()
+            except BaseException:
+                # Leaving the pool waits for the emails in flight; wake any waiting to send or retry
+                stopped.set()
+                raise
+        
+    def _send_graph_batches(self, recipients: List[str], message_parts: Tuple[bytes, bytes],
+                            min_delay: int, max_delay: int, max_retries: int, results: dict):
+        """
+        Send emails in groups through the Graph $batch endpoint, retrying failed ones.
+        
+        Args:
+            recipients: List of recipient email addresses
+            message_parts: Pre-serialized body from serialize_message
+            min_delay: Minimum delay between groups in seconds
+            max_delay: Maximum delay between groups in seconds
+            max_retries: Maximum number of retries for failed emails
+            results: Summary dict updated in place
+        """
+        for start in range(0, len(recipients), GRAPH_BATCH_LIMIT):
+            group = recipients[start:start + GRAPH_BATCH_LIMIT]
+            logger.info(f"Processing recipients {start+1}-{start+len(group)}/{len(recipients)} via $batch")
             
-            # Try to send email with retries
-            success = False
+            # Indices into group that still need to be sent
+            pending = list(range(len(group)))
             for attempt in range(max_retries + 1):
                 if attempt > 0:
-                    logger.info(f"Retry attempt {attempt}/{max_retries} for {recipient}")
+                    logger.info(f"Retry attempt {attempt}/{max_retries} for {len(pending)} recipients")
                     
-                if self.email_sender.send_email(recipient, subject, processed_html, attachments, cc_addresses):
-                    success = True
+                statuses = self.email_sender.send_batch_via_graph(
+                    [self.email_sender.render_message(group[i], message_parts) for i in pending])
+                pending = [i for i, sent in zip(pending, statuses) if not sent]
+                
+                if not pending:
                     break
                 elif attempt < max_retries:
-                    # Check if this was a token expiration issue
-                    # If so, we should re-authenticate and retry immediately
-                    # Otherwise, use exponential backoff
                     delay = min(60 * (2 ** attempt), 300)  # Max 5 minutes
-                    logger.warning(f"Send failed, waiting {delay} seconds before retry...")
+                    logger.warning(f"{len(pending)} sends failed, waiting {delay} seconds before retry...")
                     time.sleep(delay)
-                    
-            # Record result
-            timestamp = datetime.now().isoformat()
-            if success:
-                results["sent"] += 1
-                results["details"].append({
-                    "timestamp": timestamp,
-                    "recipient": recipient,
-                    "status": "success"
-                })
-            else:
-                results["failed"] += 1
-                results["details"].append({
-                    "timestamp": timestamp,
-                    "recipient": recipient,
-                    "status": "failed"
-                })
-                logger.error(f"Failed to send email to {recipient} after {max_retries} retries")
+            
+            # Record results
+            failed = set(pending)
+            for i, recipient in enumerate(group):
+                self._record_result(results, recipient, i not in failed, max_retries)
+            _buffered_file_handler.flush()
                 
-            # Add delay before next email (except for the last one)
-            if i < len(recipients) - 1:
-                delay = random.randint(min_delay, max_delay)
-                logger.info(f"Waiting {delay} seconds before next email...")
+            # Add delay before next group (except for the last one)
+            if start + GRAPH_BATCH_LIMIT < len(recipients):
+                delay = min_delay + random.random() * (max_delay - min_delay)
+                logger.info(f"Waiting {delay:.1f} seconds before next batch...")
                 time.sleep(delay)
                 
-        logger.info(f"Batch sending completed. Sent: {results['sent']}, Failed: {results['failed']}")
-        return results
\ No newline at end of file
+    def _record_result(self, results: dict, recipient: str, success: bool, max_retries: int):
+        """
+        Record the outcome of sending to one recipient in the results summary.
+        
+        Args:
+            results: Summary dict updated in place
+            recipient: Recipient email address
+            success: Whether the email was sent
+            max_retries: Maximum number of retries, for the failure log message
+        """
+        timestamp = datetime.now().isoformat()
+        if success:
+            results["sent"] += 1
+            results["details"].append({
+                "timestamp": timestamp,
+                "recipient": recipient,
+                "status": "success"
+            })
+        else:
+            results["failed"] += 1
+            results["details"].append({
+                "timestamp": timestamp,
+                "recipient": recipient,
+                "status": "failed"
+            })
+            logger.error(f"Failed to send email to {recipient} after {max_retries} retries")
@@ -0,0 +1,30 @@
+"""
+JSON helpers that use orjson when it is installed and fall back to the standard library.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    loads = orjson.loads
+    # orjson serializes straight to UTF-8 bytes
+    dumps = orjson.dumps
+else:
+    loads = json.loads
+
+    def dumps(obj) -> bytes:
+        """
+        Serialize an object to JSON bytes.
+        
+        Args:
+            obj: JSON-serializable object
+            
+        Returns:
+            bytes: Serialized JSON
+        """
+        return json.dumps(obj).encode()
@@ -30,9 +30,12 @@ setup(
         "msal>=1.20.0",
         "requests>=2.25.1",
         "beautifulsoup4>=4.12.0",
-        "html5lib>=1.1",
+        "lxml>=4.9.0",
     ],
     extras_require={
+        "fast": [
+            "orjson>=3.6",
+        ],
         "dev": [
             "pytest>=6.0",
             "pytest-cov>=2.0",
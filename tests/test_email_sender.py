@@ -2,8 +2,18 @@
 Unit tests for the email sender module
 """
 
+import base64
+import json
+import mmap
+import os
+import tempfile
+import time
 import unittest
-from email_batch_tool.utils.email_sender import OutlookEmailSender, BatchEmailProcessor
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from unittest import mock
+from email_batch_tool.utils.email_sender import OutlookEmailSender, BatchEmailProcessor, _b64_file
 
 
 class TestEmailSender(unittest.TestCase):
@@ -28,6 +38,343 @@ class TestEmailSender(unittest.TestCase):
         sanitized = sender.sanitize_html(html_with_script)
         self.assertNotIn("<script>", sanitized)
 
+    def test_prepare_template(self):
+        """Test single-pass sanitization and inline image extraction"""
+        sender = OutlookEmailSender("tenant", "client", "secret", "mailbox")
+        
+        html = '<p>Hi</p><script>alert(1);</script><img src="data:image/png;base64,iVBORw0KGgo=">'
+        processed, attachments = sender.prepare_template(html)
+        self.assertNotIn("<script>", processed)
+        self.assertIn('src="cid:image_1@example.com"', processed)
+        self.assertEqual(len(attachments), 1)
+        self.assertEqual(attachments[0]["contentType"], "image/png")
+        self.assertEqual(attachments[0]["contentBytes"], "iVBORw0KGgo=")
+        
+        # Memory-mapped templates are parsed as UTF-8 bytes
+        with tempfile.TemporaryFile() as f:
+            f.write("<p>Grüße</p><style>p {}</style>".encode("utf-8"))
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as template:
+                processed, attachments = sender.prepare_template(template)
+        self.assertIn("<p>Grüße</p>", processed)
+        self.assertNotIn("<style>", processed)
+        self.assertEqual(attachments, [])
+
+    def test_prepare_template_without_parser(self):
+        """Test that templates without script or style are rewritten in place"""
+        sender = OutlookEmailSender("tenant", "client", "secret", "mailbox")
+        
+        html = ('<div><IMG alt="a" SRC="data:image/png;base64,AAAA">'
+                "<img data-src=\"x.png\" src='data:image/gif;base64,BBBB'>"
+                '<img src="https://example.com/logo.png"></div>')
+        with mock.patch("email_batch_tool.utils.email_sender.BeautifulSoup") as soup:
+            processed, attachments = sender.prepare_template(html)
+        soup.assert_not_called()
+        self.assertEqual(processed, '<div><IMG alt="a" SRC="cid:image_1@example.com">'
+                                    "<img data-src=\"x.png\" src='cid:image_2@example.com'>"
+                                    '<img src="https://example.com/logo.png"></div>')
+        self.assertEqual([a["contentBytes"] for a in attachments], ["AAAA", "BBBB"])
+        
+        # Unquoted src values fall back to the parser
+        processed, attachments = sender.prepare_template('<img src=data:image/png;base64,AAAA>')
+        self.assertIn('src="cid:image_1@example.com"', processed)
+        self.assertEqual(len(attachments), 1)
+        
+        # A '>' inside another attribute value does not end the tag
+        processed, attachments = sender.prepare_template('<p><img alt="a > b" src="data:image/png;base64,AAAA"></p>')
+        self.assertIn('src="cid:image_1@example.com"', processed)
+        self.assertEqual(len(attachments), 1)
+        
+        # A "src=" inside another attribute value is not the image source
+        processed, attachments = sender.prepare_template(
+            '<img alt="x src=\'data:image/png;base64,AAAA\'" src="data:image/png;base64,BBBB">')
+        self.assertIn('alt="x src=\'data:image/png;base64,AAAA\'"', processed)
+        self.assertIn('src="cid:image_1@example.com"', processed)
+        self.assertEqual([a["contentBytes"] for a in attachments], ["BBBB"])
+        
+        # Commented-out images are not attached
+        processed, attachments = sender.prepare_template('<p>Hi</p><!-- <img src="data:image/png;base64,AAAA"> -->')
+        self.assertIn('<img src="data:image/png;base64,AAAA">', processed)
+        self.assertEqual(attachments, [])
+
+    def test_prepare_template_cached(self):
+        """Test that an identical template is only processed once"""
+        sender = OutlookEmailSender("tenant", "client", "secret", "mailbox")
+        html = '<p>Hi</p><img src="data:image/png;base64,iVBORw0KGgo=">'
+        
+        with mock.patch("email_batch_tool.utils.email_sender._template_cache", OrderedDict()), \
+                mock.patch.object(sender, "prepare_template", wraps=sender.prepare_template) as prepare:
+            first = sender.prepare_template_cached(html)
+            first[1][0]["contentBytes"] = "changed"
+            second = sender.prepare_template_cached(html.encode("utf-8"))
+        
+        self.assertEqual(prepare.call_count, 1)
+        self.assertEqual(first[0], second[0])
+        self.assertEqual(second[1][0]["contentBytes"], "iVBORw0KGgo=")
+
+    def test_b64_file(self):
+        """Test that chunked base64 encoding matches a one-shot encode"""
+        data = os.urandom(100001)
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(data)
+        try:
+            self.assertEqual(_b64_file(f.name), base64.b64encode(data).decode('ascii'))
+        finally:
+            os.unlink(f.name)
+
+    def test_local_images(self):
+        """Test that local images are loaded and numbered in document order"""
+        sender = OutlookEmailSender("tenant", "client", "secret", "mailbox")
+        
+        with tempfile.TemporaryDirectory() as template_dir:
+            images_dir = os.path.join(template_dir, "images")
+            os.mkdir(images_dir)
+            for name, data in [("a.png", b"first"), ("b.jpg", b"second")]:
+                with open(os.path.join(images_dir, name), "wb") as f:
+                    f.write(data)
+            
+            html = '<img src="b.jpg"><img src="missing.png"><img src="images/a.png"><img src="b.jpg">'
+            with mock.patch("email_batch_tool.utils.email_sender._TEMPLATE_DIR", template_dir), \
+                    mock.patch("email_batch_tool.utils.email_sender._IMAGES_DIR", images_dir):
+                processed, attachments = sender.prepare_template(html)
+        
+        self.assertEqual(processed, '<img src="cid:image_1@example.com"><img src="missing.png">'
+                                    '<img src="cid:image_2@example.com"><img src="cid:image_3@example.com">')
+        self.assertEqual([(a["name"], a["contentType"], base64.b64decode(a["contentBytes"])) for a in attachments],
+                         [("b.jpg", "image/jpeg", b"second"), ("a.png", "image/png", b"first"),
+                          ("b.jpg", "image/jpeg", b"second")])
+
+    def test_authenticate_reuses_msal_app(self):
+        """Test that re-authenticating does not rebuild the MSAL application"""
+        with mock.patch("msal.ConfidentialClientApplication") as app:
+            app.return_value.acquire_token_for_client.return_value = {"access_token": "token", "expires_in": 3599}
+            sender = OutlookEmailSender("tenant", "client", "secret", "mailbox")
+            self.assertTrue(sender.authenticate())
+            self.assertTrue(sender.authenticate())
+        
+        app.assert_called_once()
+        self.assertEqual(app.call_args.kwargs["authority"], "https://login.microsoftonline.com/tenant")
+        self.assertEqual(app.return_value.acquire_token_for_client.call_count, 2)
+        self.assertFalse(sender.is_token_expired())
+
+    def test_send_email_reuses_session(self):
+        """Test that consecutive sends go through the same pooled session"""
+        with mock.patch("msal.ConfidentialClientApplication") as app:
+            app.return_value.acquire_token_for_client.return_value = {"access_token": "token"}
+            sender = OutlookEmailSender("tenant", "client", "secret", "mailbox")
+            self.assertTrue(sender.authenticate())
+        
+        with mock.patch.object(sender._session, "post") as post:
+            post.return_value.status_code = 202
+            self.assertTrue(sender.send_email("a@example.com", "Subject", "<p>Hi</p>"))
+            self.assertTrue(sender.send_email("b@example.com", "Subject", "<p>Hi</p>"))
+            self.assertEqual(post.call_count, 2)
+
+            body = json.loads(post.call_args.kwargs["data"])
+            self.assertEqual(body["message"]["toRecipients"][0]["emailAddress"]["address"], "b@example.com")
+            
+            with self.assertLogs("email_batch_tool.utils.email_sender", "INFO") as logs:
+                sender.send_email("c@example.com", "Subject", "<p>Hi</p>", cc_addresses=["cc@example.com"])
+            self.assertIn("Email sent successfully to c@example.com with CC to cc@example.com", logs.output[-1])
+
+    def test_send_email_reauthenticates_after_rejected_token(self):
+        """Test that a 401 retry carries a new token rather than the cached, rejected one"""
+        with mock.patch("msal.ConfidentialClientApplication") as app:
+            app.return_value.acquire_token_for_client.side_effect = [
+                {"access_token": "rejected", "expires_in": 3599},
+                {"access_token": "fresh", "expires_in": 3599},
+            ]
+            sender = OutlookEmailSender("tenant", "client", "secret", "mailbox")
+            self.assertTrue(sender.authenticate())
+            
+            rejected = mock.Mock(status_code=401)
+            rejected.json.return_value = {"error": {"code": "InvalidAuthenticationToken"}}
+            with mock.patch.object(sender._session, "post", side_effect=[rejected, mock.Mock(status_code=202)]) as post:
+                self.assertTrue(sender.send_email("a@example.com", "Subject", "<p>Hi</p>"))
+        
+        self.assertEqual([c.kwargs["headers"]["Authorization"] for c in post.call_args_list],
+                         ["Bearer rejected", "Bearer fresh"])
+        self.assertEqual(app.call_count, 2)
+
+    def test_serialize_message(self):
+        """Test that splicing a recipient into the serialized body yields valid JSON"""
+        sender = OutlookEmailSender("tenant", "client", "secret", "mailbox")
+        template = sender.build_message("__RECIPIENT__", "<p>Hi</p>", cc_addresses=["cc@example.com"])
+        prefix, suffix = sender.serialize_message(template)
+        
+        body = json.loads(prefix + json.dumps('"quoted"@example.com').encode() + suffix)
+        self.assertEqual(body["message"]["subject"], "__RECIPIENT__")
+        self.assertEqual(body["message"]["toRecipients"], [{"emailAddress": {"address": '"quoted"@example.com'}}])
+        self.assertEqual(body["message"]["ccRecipients"], [{"emailAddress": {"address": "cc@example.com"}}])
+        self.assertTrue(body["saveToSentItems"])
+
+    def test_send_batch_via_graph(self):
+        """Test that $batch subresponses are mapped back to their messages"""
+        with mock.patch("msal.ConfidentialClientApplication") as app:
+            app.return_value.acquire_token_for_client.return_value = {"access_token": "token"}
+            sender = OutlookEmailSender("tenant", "client", "secret", "mailbox")
+            self.assertTrue(sender.authenticate())
+        
+        parts = sender.serialize_message(sender.build_message("Subject", "<p>Hi</p>"))
+        messages = [sender.render_message(f"user{i}@example.com", parts) for i in range(25)]
+        
+        def fake_post(url, headers, data, timeout):
+            subrequests = json.loads(data)["requests"]
+            # Fail the first subrequest of each call and answer in reverse order
+            responses = [{"id": r["id"], "status": 429 if n == 0 else 202} for n, r in enumerate(subrequests)]
+            return mock.Mock(status_code=200, content=json.dumps({"responses": responses[::-1]}).encode())
+        
+        with mock.patch.object(sender._session, "post", side_effect=fake_post) as post:
+            statuses = sender.send_batch_via_graph(messages)
+        
+        self.assertEqual(post.call_count, 2)
+        first = json.loads(post.call_args_list[0].kwargs["data"])["requests"]
+        self.assertEqual(len(first), 20)
+        self.assertEqual(first[3]["body"]["message"]["toRecipients"][0]["emailAddress"]["address"], "user3@example.com")
+        self.assertEqual(statuses, [False] + [True] * 19 + [False] + [True] * 4)
+
+    def test_send_batch_via_graph_limits_body_size(self):
+        """Test that $batch calls are split to stay under the request size limit"""
+        with mock.patch("msal.ConfidentialClientApplication") as app:
+            app.return_value.acquire_token_for_client.return_value = {"access_token": "token"}
+            sender = OutlookEmailSender("tenant", "client", "secret", "mailbox")
+            self.assertTrue(sender.authenticate())
+        
+        parts = sender.serialize_message(sender.build_message("Subject", "<p>" + "x" * 1000 + "</p>"))
+        messages = [sender.render_message(f"user{i}@example.com", parts) for i in range(5)]
+        
+        def fake_post(url, headers, data, timeout):
+            responses = [{"id": r["id"], "status": 202} for r in json.loads(data)["requests"]]
+            return mock.Mock(status_code=200, content=json.dumps({"responses": responses}).encode())
+        
+        with mock.patch("email_batch_tool.utils.email_sender.GRAPH_BATCH_MAX_BYTES", 3000), \
+                mock.patch.object(sender._session, "post", side_effect=fake_post) as post:
+            statuses = sender.send_batch_via_graph(messages)
+        
+        self.assertEqual(statuses, [True] * 5)
+        self.assertEqual([len(json.loads(c.kwargs["data"])["requests"]) for c in post.call_args_list], [2, 2, 1])
+        self.assertTrue(all(len(c.kwargs["data"]) <= 3000 for c in post.call_args_list))
+
+    def test_send_batch_flushes_log_per_result(self):
+        """Test that the log file is flushed as soon as each send result is recorded"""
+        sender = OutlookEmailSender("tenant", "client", "secret", "mailbox")
+        flushed = []
+        
+        def send_email(to_address, *args, **kwargs):
+            # Everything logged for the previous recipient has reached the file by now
+            flushed.append(flush.call_count)
+            return True
+        
+        recipients = ["a@example.com", "b@example.com"]
+        with mock.patch.object(sender, "send_email", side_effect=send_email), mock.patch("time.sleep"), \
+                mock.patch.object(BatchEmailProcessor, "_start_token_refresh"), \
+                mock.patch("email_batch_tool.utils.email_sender._buffered_file_handler.flush") as flush:
+            BatchEmailProcessor(sender).send_batch(recipients, "Subject", "<p>Hi</p>", min_delay=0, max_delay=0)
+        
+        self.assertEqual(flushed, [0, 1])
+        self.assertEqual(flush.call_count, 3)
+
+    def test_send_batch_concurrently(self):
+        """Test that concurrent sending retries failures and records every recipient"""
+        sender = OutlookEmailSender("tenant", "client", "secret", "mailbox")
+        attempts = {}
+        
+        def send_email(to_address, *args, **kwargs):
+            attempts[to_address] = attempts.get(to_address, 0) + 1
+            return to_address != "bad@example.com" and attempts[to_address] > 1
+        
+        recipients = [f"user{i}@example.com" for i in range(6)] + ["bad@example.com"]
+        with mock.patch.object(sender, "send_email", side_effect=send_email), mock.patch("time.sleep"), \
+                mock.patch.object(BatchEmailProcessor, "_start_token_refresh"):
+            results = BatchEmailProcessor(sender).send_batch(recipients, "Subject", "<p>Hi</p>", min_delay=0,
+                                                             max_delay=0, max_retries=1, concurrency=3)
+        
+        self.assertEqual((results["sent"], results["failed"]), (6, 1))
+        self.assertEqual(sorted(d["recipient"] for d in results["details"]), sorted(recipients))
+        self.assertEqual(attempts["bad@example.com"], 2)
+
+    def test_send_batch_concurrently_stops_on_interrupt(self):
+        """Test that an interrupt during concurrent sending stops the remaining emails"""
+        sender = OutlookEmailSender("tenant", "client", "secret", "mailbox")
+        attempted = []
+        
+        def send_email(to_address, *args, **kwargs):
+            attempted.append(to_address)
+            if to_address == "user0@example.com":
+                raise KeyboardInterrupt
+            time.sleep(0.05)
+            return True
+        
+        recipients = [f"user{i}@example.com" for i in range(20)]
+        with mock.patch.object(sender, "send_email", side_effect=send_email), \
+                mock.patch.object(BatchEmailProcessor, "_start_token_refresh"):
+            with self.assertRaises(KeyboardInterrupt):
+                BatchEmailProcessor(sender).send_batch(recipients, "Subject", "<p>Hi</p>", min_delay=0,
+                                                       max_delay=0, max_retries=1, concurrency=2)
+        
+        self.assertEqual(sorted(attempted), ["user0@example.com", "user1@example.com"])
+
+    def test_send_batch_concurrently_interrupt_cancels_retries(self):
+        """Test that an interrupt wakes workers in retry backoff without sending again"""
+        sender = OutlookEmailSender("tenant", "client", "secret", "mailbox")
+        attempted = []
+        
+        def send_email(to_address, *args, **kwargs):
+            attempted.append(to_address)
+            if to_address == "user0@example.com":
+                # Give the other worker time to fail and start its backoff
+                time.sleep(0.1)
+                raise KeyboardInterrupt
+            return False
+        
+        recipients = [f"user{i}@example.com" for i in range(4)]
+        started = time.monotonic()
+        with mock.patch.object(sender, "send_email", side_effect=send_email), \
+                mock.patch.object(BatchEmailProcessor, "_start_token_refresh"):
+            with self.assertRaises(KeyboardInterrupt):
+                BatchEmailProcessor(sender).send_batch(recipients, "Subject", "<p>Hi</p>", min_delay=0,
+                                                       max_delay=0, max_retries=3, concurrency=2)
+        
+        # The 60 second backoff was cut short and the failed email was not retried
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertEqual(sorted(attempted), ["user0@example.com", "user1@example.com"])
+
+    def test_token_refresh_scheduled_before_expiry(self):
+        """Test that the background refresh fires 4 minutes before the token expires"""
+        sender = OutlookEmailSender("tenant", "client", "secret", "mailbox")
+        sender.token_expires_at = datetime.now() + timedelta(minutes=60)
+        processor = BatchEmailProcessor(sender)
+        
+        with mock.patch("threading.Timer") as timer:
+            processor._start_token_refresh()
+            delay, callback = timer.call_args.args
+            self.assertAlmostEqual(delay, 56 * 60, delta=5)
+            self.assertEqual(callback, processor._refresh_token)
+            timer.return_value.start.assert_called_once()
+            
+            processor._cancel_token_refresh()
+            timer.return_value.cancel.assert_called_once()
+            
+            # A refresh that completes after cancellation does not reschedule
+            with mock.patch.object(sender, "authenticate", return_value=True):
+                processor._refresh_token()
+            self.assertEqual(timer.call_count, 1)
+
+    def test_concurrent_ensure_token_authenticates_once(self):
+        """Test that threads needing a token wait for a single authentication"""
+        with mock.patch("msal.ConfidentialClientApplication") as app:
+            sender = OutlookEmailSender("tenant", "client", "secret", "mailbox")
+            
+            def acquire_token_for_client(scopes):
+                time.sleep(0.1)
+                return {"access_token": "token", "expires_in": 3599}
+            
+            app.return_value.acquire_token_for_client.side_effect = acquire_token_for_client
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                self.assertTrue(all(executor.map(lambda _: sender.ensure_token(), range(4))))
+        
+        self.assertEqual(app.return_value.acquire_token_for_client.call_count, 1)
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file